@@ -1,13 +1,21 @@
 import asyncio
 import websockets
 import json
+import orjson
 import threading
 import sys
 import time
 import os
-from openpyxl import Workbook, load_workbook
+import sqlite3
+from dataclasses import dataclass
+from openpyxl import load_workbook
 from datetime import datetime, timedelta, date, time as dt_time
 
+try:
+    import uvloop # Optional: faster libuv-based event loop (not available on Windows)
+except ImportError:
+    uvloop = None
+
 # --- Client Configuration ---
 SERVER_URL = "ws://localhost:8765"
 CLIENT_NAME = "db_client" # This client's name
@@ -15,58 +23,96 @@ TARGET_NAME = "esp_client" # The name of the client this program will send messa
 # ----------------------------
 
 # --- File Paths ---
-USER_DB_FILE = "userDatabase.xlsx"
-USER_LOG_FILE = "userLog.xlsx"
+DB_FILE = "attendance.db"
+SCHEMA_VERSION = 2 # Stored in PRAGMA user_version once initialize_files() has set everything up
+USER_DB_FILE = "userDatabase.xlsx" # Legacy store, imported once into DB_FILE
+USER_LOG_FILE = "userLog.xlsx" # Legacy store, imported once into DB_FILE
 SETTINGS_FILE = "Settings.json"
 
+# Timestamps are stored as sortable text so window checks run on the index
+LOG_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# --- Data Types ---
+@dataclass(slots=True)
+class User:
+    """A cached row of the users table."""
+    name: str
+    title: str
+
 # --- Global Data Storage (In-Memory Caches) ---
-# USER_DATABASE: {user_id: {'name': user_name, 'title': user_title}}
+# USER_DATABASE: {user_id: User(name, title)}
+# ADMIN_IDS: {user_id} of users whose title is 'admin' (kept in lockstep with USER_DATABASE)
+# LAST_ENTRY: {user_id: (row_id, tap_in_time, status)} for entries in the current window
 SETTINGS = {}
 USER_DATABASE = {} 
+ADMIN_IDS = set()
+LAST_ENTRY = {}
+DB_CONN = None
+DB_LOCK = threading.Lock() # Serializes writes issued from asyncio.to_thread workers
+
+# Current attendance window (start, end, reset_time_str), recomputed only once 'end' has passed
+_ONE_DAY = timedelta(days=1)
+_WINDOW_CACHE = (None, datetime.min, None)
 
 # =============================================================
 # FILE MANAGEMENT FUNCTIONS
 # =============================================================
 
 def initialize_files():
-    """Initializes Excel and JSON files if they do not exist."""
+    """Opens the SQLite database and, on first run only, creates its schema and Settings.json."""
+    global DB_CONN
+    DB_CONN = sqlite3.connect(DB_FILE, check_same_thread=False)
+    DB_CONN.execute("PRAGMA synchronous=NORMAL")
+
+    # Warm start: user_version is only set once every step below has completed
+    schema_version = DB_CONN.execute("PRAGMA user_version").fetchone()[0]
+    if schema_version == SCHEMA_VERSION:
+        return
+
     print("[INIT] Checking/creating necessary files...")
-    
-    # 1. userDatabase.xlsx
-    if not os.path.exists(USER_DB_FILE):
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Users"
-        ws.append(['user_id', 'user_name', 'user_title'])
-        
-        # --- Add Default Admin User ---
-        ws.append(['426E3302', 'master_admin', 'admin']) # --- Add here the default Admin RFID ---
-        
-        wb.save(USER_DB_FILE)
-        print(f"[INIT] Created {USER_DB_FILE} with headers and default admin (426E3302).")
+    DB_CONN.execute("PRAGMA journal_mode=WAL") # Cannot run inside a transaction
 
-    # 2. userLog.xlsx
-    if not os.path.exists(USER_LOG_FILE):
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Log"
-        ws.append(['user_id', 'tap_in_time', 'tap_out_time', 'status', 'duration'])
-        wb.save(USER_LOG_FILE)
-        print(f"[INIT] Created {USER_LOG_FILE} with headers.")
-
-    # 3. Settings.json
-    if not os.path.exists(SETTINGS_FILE):
-        default_settings = {"reset_time": "05:00:00"}
-        with open(SETTINGS_FILE, 'w') as f:
-            json.dump(default_settings, f, indent=4) 
-        print(f"[INIT] Created {SETTINGS_FILE} with default reset time (05:00:00).")
+    # One explicit transaction: if any step fails, user_version stays as it was and the next start retries
+    DB_CONN.execute("BEGIN")
+    try:
+        # 1. attendance.db (users table)
+        DB_CONN.execute("CREATE TABLE IF NOT EXISTS users(user_id TEXT PRIMARY KEY, name TEXT, title TEXT)")
+        if schema_version == 0 and DB_CONN.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0:
+            if os.path.exists(USER_DB_FILE):
+                import_legacy_user_db()
+            else:
+                # --- Add Default Admin User ---
+                DB_CONN.execute("INSERT INTO users VALUES (?, ?, ?)", ('426E3302', 'master_admin', 'admin')) # --- Add here the default Admin RFID ---
+                print(f"[INIT] Created {DB_FILE} with default admin (426E3302).")
+
+        # 2. attendance.db (log table)
+        DB_CONN.execute("CREATE TABLE IF NOT EXISTS log(id INTEGER PRIMARY KEY, user_id TEXT, tap_in DATETIME, tap_out DATETIME, status TEXT, duration TEXT)")
+        DB_CONN.execute("CREATE INDEX IF NOT EXISTS ix_log_user_time ON log(user_id, tap_in DESC)")
+        DB_CONN.execute("CREATE INDEX IF NOT EXISTS ix_log_tap_in ON log(tap_in)")
+        if schema_version == 0 and os.path.exists(USER_LOG_FILE) and DB_CONN.execute("SELECT COUNT(*) FROM log").fetchone()[0] == 0:
+            import_legacy_user_log()
+
+        # 3. Settings.json
+        if not os.path.exists(SETTINGS_FILE):
+            default_settings = {"reset_time": "05:00:00"}
+            with open(SETTINGS_FILE, 'w') as f:
+                json.dump(default_settings, f, indent=4) 
+            print(f"[INIT] Created {SETTINGS_FILE} with default reset time (05:00:00).")
+
+        DB_CONN.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        DB_CONN.commit()
+    except Exception:
+        DB_CONN.rollback()
+        raise
 
 def save_settings():
     """Saves the current SETTINGS dictionary back to Settings.json."""
+    # Keys starting with '_' are parsed runtime values, not persisted settings
+    settings_to_save = {k: v for k, v in SETTINGS.items() if not k.startswith('_')}
     try:
         with open(SETTINGS_FILE, 'w') as f:
-            json.dump(SETTINGS, f, indent=4)
-        print(f"[SAVE] Settings saved: {SETTINGS}")
+            json.dump(settings_to_save, f, indent=4)
+        print(f"[SAVE] Settings saved: {settings_to_save}")
     except Exception as e:
         print(f"[ERROR] Could not save settings: {e}")
 
@@ -80,118 +126,199 @@ def load_settings():
     except Exception as e:
         print(f"[ERROR] Could not load settings: {e}. Using default.")
         SETTINGS = {"reset_time": "05:00:00"}
+    cache_reset_time()
 
-def save_user_db():
-    """Overwrites userDatabase.xlsx using the current USER_DATABASE cache."""
+def import_legacy_user_db():
+    """Copies users from a legacy userDatabase.xlsx into the users table (first run only)."""
     try:
-        wb = Workbook()
+        # Read-only mode streams rows as plain values without building styled Cell objects
+        wb = load_workbook(USER_DB_FILE, read_only=True, data_only=True)
         ws = wb.active
-        ws.title = "Users"
-        ws.append(['user_id', 'user_name', 'user_title'])
         
-        for user_id, user_data in USER_DATABASE.items():
-            ws.append([user_id, user_data['name'], user_data['title']])
-        
-        wb.save(USER_DB_FILE)
-        print(f"[SAVE] User database saved. Total users: {len(USER_DATABASE)}")
+        # Skip header row (index 1)
+        rows = [(str(row[0]), str(row[1]), str(row[2])) for row in ws.iter_rows(min_row=2, values_only=True) if row[0]]
+        wb.close()
+        DB_CONN.executemany("INSERT OR REPLACE INTO users VALUES (?, ?, ?)", rows)
+        print(f"[INIT] Imported {len(rows)} users from {USER_DB_FILE} into {DB_FILE}.")
+    except Exception as e:
+        print(f"[ERROR] Could not import legacy user database: {e}")
+        raise
+
+def save_user_db(user_id, user_name, user_title):
+    """Inserts or updates a single user row in the users table."""
+    try:
+        with DB_LOCK, DB_CONN:
+            DB_CONN.execute("INSERT OR REPLACE INTO users VALUES (?, ?, ?)", (user_id, user_name, user_title))
+        print(f"[SAVE] User '{user_id}' saved. Total users: {len(USER_DATABASE)}")
     except Exception as e:
         print(f"[ERROR] Could not save user database: {e}")
 
+def delete_user_db(user_id):
+    """Deletes a single user row from the users table."""
+    try:
+        with DB_LOCK, DB_CONN:
+            DB_CONN.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+        print(f"[SAVE] User '{user_id}' deleted. Total users: {len(USER_DATABASE)}")
+    except Exception as e:
+        print(f"[ERROR] Could not delete user from database: {e}")
+
 def load_user_db():
-    """Loads user data from userDatabase.xlsx into USER_DATABASE cache."""
-    global USER_DATABASE
+    """Loads user data from the users table into USER_DATABASE cache."""
+    global USER_DATABASE, ADMIN_IDS
     USER_DATABASE = {}
+    ADMIN_IDS = set()
     try:
-        wb = load_workbook(USER_DB_FILE)
-        ws = wb.active
-        
-        # Skip header row (index 1)
-        for row in ws.iter_rows(min_row=2, values_only=True):
-            if row[0]: # Check if user_id exists
-                # Store name and title in the cache
-                USER_DATABASE[str(row[0])] = {'name': str(row[1]), 'title': str(row[2])}
+        for user_id, user_name, user_title in DB_CONN.execute("SELECT user_id, name, title FROM users"):
+            # Store name and title in the cache
+            USER_DATABASE[user_id] = User(user_name, user_title)
+            if user_title.lower() == 'admin':
+                ADMIN_IDS.add(user_id)
         print(f"[LOAD] User database loaded. Total users: {len(USER_DATABASE)}")
     except Exception as e:
         print(f"[ERROR] Could not load user database: {e}")
 
-def get_current_log_sheet():
-    """Returns the active worksheet for the user log."""
-    return load_workbook(USER_LOG_FILE).active
+def format_log_time(value):
+    """Converts a legacy Excel cell value into the LOG_TIME_FORMAT text stored in the log table."""
+    if isinstance(value, datetime):
+        return value.strftime(LOG_TIME_FORMAT)
+    if isinstance(value, dt_time):
+        # Time-only cells were read as today's time by the old xlsx lookup; keep that meaning
+        return datetime.combine(date.today(), value).strftime(LOG_TIME_FORMAT)
+    return str(value) if value is not None else None
+
+def import_legacy_user_log():
+    """Copies entries from a legacy userLog.xlsx into the log table (first run only)."""
+    try:
+        wb = load_workbook(USER_LOG_FILE, read_only=True, data_only=True)
+        ws = wb.active
+        
+        # Skip header row (index 1)
+        rows = [
+            (str(row[0]), format_log_time(row[1]), format_log_time(row[2]), row[3], row[4])
+            for row in ws.iter_rows(min_row=2, max_col=5, values_only=True) if row[0]
+        ]
+        wb.close()
+        DB_CONN.executemany("INSERT INTO log(user_id, tap_in, tap_out, status, duration) VALUES (?, ?, ?, ?, ?)", rows)
+        print(f"[INIT] Imported {len(rows)} log entries from {USER_LOG_FILE} into {DB_FILE}.")
+    except Exception as e:
+        print(f"[ERROR] Could not import legacy user log: {e}")
+        raise
 
 def save_user_log(data_to_write):
-    """Appends new data to the user log file."""
+    """Appends a new entry to the log table. Returns the new row id, or None on failure."""
     try:
-        wb = load_workbook(USER_LOG_FILE)
-        ws = wb.active
-        ws.append(data_to_write)
-        wb.save(USER_LOG_FILE)
+        with DB_LOCK, DB_CONN:
+            cursor = DB_CONN.execute("INSERT INTO log(user_id, tap_in, tap_out, status, duration) VALUES (?, ?, ?, ?, ?)", data_to_write)
         print(f"[SAVE] Log saved: {data_to_write}")
+        return cursor.lastrowid
     except Exception as e:
         print(f"[ERROR] Could not save user log: {e}")
+        return None
+
+def update_user_log(row_id, tap_out_time, duration_str):
+    """Marks an existing Tap In entry as Tap Out. Raises on database errors or if no open entry was updated."""
+    with DB_LOCK, DB_CONN:
+        # Only an open Tap In row may be closed; anything else updates nothing
+        cursor = DB_CONN.execute(
+            "UPDATE log SET tap_out = ?, status = 'Tap Out', duration = ? WHERE id = ? AND status = 'Tap In'",
+            (tap_out_time, duration_str, row_id)
+        )
+    if cursor.rowcount == 0:
+        raise LookupError(f"Log entry {row_id} is missing or already tapped out")
 
 # =============================================================
 # TIME AND DURATION HELPERS (Used by SCAN)
 # =============================================================
 
-def get_current_reset_window():
-    """Calculates the start and end of the current 24-hour attendance window."""
+def parse_reset_time(time_value):
+    """Parses 'HH:MM:SS' or 'HH:MM' into a time object. Raises ValueError on any other format."""
+    try:
+        return datetime.strptime(time_value, "%H:%M:%S").time()
+    except ValueError:
+        return datetime.strptime(time_value, "%H:%M").time()
+
+def set_reset_time(reset_time):
+    """Stores the canonical and parsed reset time in SETTINGS and invalidates the window cache."""
+    global _WINDOW_CACHE
+    SETTINGS['reset_time'] = reset_time.strftime('%H:%M:%S')
+    SETTINGS['_reset_time_obj'] = reset_time
+    _WINDOW_CACHE = (None, datetime.min, None)
+
+def cache_reset_time():
+    """Parses SETTINGS['reset_time'] once into SETTINGS['_reset_time_obj']."""
     
     reset_time_str = SETTINGS.get("reset_time", "05:00:00")
     try:
-        # Pad time if needed (e.g., '05:00' to '05:00:00')
-        parts = reset_time_str.split(':')
-        if len(parts) == 2:
-             reset_time_str += ':00'
-        h, m, s = map(int, reset_time_str.split(':'))
-        reset_time = dt_time(h, m, s)
-    except ValueError:
+        reset_time = parse_reset_time(reset_time_str)
+    except (TypeError, ValueError):
         print(f"[ERROR] Invalid reset time format: {reset_time_str}. Defaulting to 05:00:00.")
-        reset_time_str = "05:00:00"
         reset_time = dt_time(5, 0, 0)
 
+    set_reset_time(reset_time)
+
+def get_current_reset_window():
+    """Returns the start and end of the current 24-hour attendance window, recomputing it only on rollover."""
+    global _WINDOW_CACHE
+    
     now = datetime.now()
-    today_reset = datetime.combine(date.today(), reset_time)
+    if now < _WINDOW_CACHE[1]:
+        return _WINDOW_CACHE
 
-    if now >= today_reset:
-        window_start = today_reset
-        window_end = today_reset + timedelta(days=1)
-    else:
-        window_start = today_reset - timedelta(days=1)
-        window_end = today_reset
-        
-    return window_start, window_end, reset_time_str
+    if '_reset_time_obj' not in SETTINGS:
+        cache_reset_time()
+
+    window_start = datetime.combine(date.today(), SETTINGS['_reset_time_obj'])
+    if now < window_start:
+        window_start -= _ONE_DAY
+
+    # Entries from earlier windows can never match again; drop them on a natural rollover.
+    # After set_reset_time() (no previous window) handle_reset_time_command rebuilds
+    # LAST_ENTRY from the log instead, which also restores entries the new window covers.
+    if _WINDOW_CACHE[0] is not None:
+        for user_id in [u for u, entry in LAST_ENTRY.items() if entry[1] < window_start]:
+            del LAST_ENTRY[user_id]
+
+    _WINDOW_CACHE = (window_start, window_start + _ONE_DAY, SETTINGS['reset_time'])
+    return _WINDOW_CACHE
 
-def find_last_entry(user_id, ws, window_start, window_end):
+def load_last_entries():
     """
-    Finds the last IN or OUT entry for a user within the current 24-hour window.
-    Returns: (row_index, tap_in_time, status) or (None, None, None)
+    Builds the LAST_ENTRY cache with a single forward pass over the current window's log entries.
+    Must be rerun whenever the reset time changes, since that moves the window.
     """
-    last_entry = None
-    last_row_index = None
-
-    for i in range(ws.max_row, 1, -1):
-        row = [cell.value for cell in ws[i]]
-        log_user_id = str(row[0]) if row[0] is not None else None
-        
-        if log_user_id == user_id:
-            try:
-                tap_in_time = row[1]
-                log_datetime = None
-                if isinstance(tap_in_time, datetime):
-                    log_datetime = tap_in_time
-                elif isinstance(tap_in_time, dt_time):
-                     log_datetime = datetime.combine(date.today(), tap_in_time)
-
-                if log_datetime and window_start <= log_datetime < window_end:
-                    last_entry = row
-                    last_row_index = i
-                    break
-            except Exception as e:
-                print(f"[ERROR] Failed to parse datetime in log row {i}: {e}")
-                continue
+    global LAST_ENTRY
+    window_start, window_end, _ = get_current_reset_window()
+    start_str = window_start.strftime(LOG_TIME_FORMAT)
+    end_str = window_end.strftime(LOG_TIME_FORMAT)
+    try:
+        # Only entries inside the current window matter for the SCAN logic, so the
+        # range scan on ix_log_tap_in never reads older history
+        latest = {}
+        with DB_LOCK:
+            rows = DB_CONN.execute(
+                "SELECT id, user_id, tap_in, status FROM log WHERE tap_in >= ? AND tap_in < ? ORDER BY tap_in, id",
+                (start_str, end_str)
+            ).fetchall()
+        for row_id, user_id, tap_in, status in rows:
+            latest[user_id] = (row_id, tap_in, status)
+
+        # Swap in the finished cache in one assignment
+        LAST_ENTRY = {
+            user_id: (row_id, datetime.strptime(tap_in, LOG_TIME_FORMAT), str(status))
+            for user_id, (row_id, tap_in, status) in latest.items()
+        }
+        print(f"[LOAD] Last log entries loaded. Users in current window: {len(LAST_ENTRY)}")
+    except Exception as e:
+        print(f"[ERROR] Could not load last log entries: {e}")
 
-    if last_entry:
-        return last_row_index, last_entry[1], str(last_entry[3])
+def find_last_entry(user_id, window_start, window_end):
+    """
+    Finds the last IN or OUT entry for a user within the current 24-hour window.
+    Returns: (row_id, tap_in_time, status) or (None, None, None)
+    """
+    entry = LAST_ENTRY.get(user_id)
+    if entry and window_start <= entry[1] < window_end:
+        return entry
     return None, None, None
 
 def calculate_duration(start_time, end_time):
@@ -214,33 +341,57 @@ def calculate_duration(start_time, end_time):
 # COMMAND HANDLERS
 # =============================================================
 
+def encode_reply(reply_msg):
+    """Wraps a reply for the ESP client in the routing envelope and encodes it."""
+    return orjson.dumps({"to": TARGET_NAME, "msg": reply_msg})
+
+def static_reply(reply_msg):
+    """Pairs a fixed reply with its encoded bytes so send_raw() can log it without decoding."""
+    return reply_msg, encode_reply(reply_msg)
+
+# Pre-encoded static replies as (reply_msg, encoded bytes), sent with send_raw()
+REPLY_SCAN_NF = static_reply({"md": "scan", "rslt": "NF"})
+REPLY_SCAN_LOG_ERR = static_reply({"md": "scan", "rslt": "LOG_ERR"})
+REPLY_SCAN_UNKNOWN_ERR = static_reply({"md": "scan", "rslt": "UNKNOWN_ERR"})
+REPLY_AUTH_ADMIN = static_reply({"md": "auth", "rslt": "admin"})
+REPLY_AUTH_NOT_ADMIN = static_reply({"md": "auth", "rslt": "not-admin"})
+REPLY_SEARCH_F = static_reply({"md": "search", "rslt": "F"}) # Found
+REPLY_SEARCH_NF = static_reply({"md": "search", "rslt": "NF"}) # Not Found
+REPLY_ADD_A = static_reply({"md": "add", "rslt": "A"})
+REPLY_DELETE_DL = static_reply({"md": "delete", "rslt": "DL"})
+REPLY_RST_TIME_D = static_reply({"md": "rst_time", "rslt": "D"})
+REPLY_RST_TIME_FAIL = static_reply({"md": "rst_time", "rslt": "FAIL"})
+
 async def send_reply(websocket, reply_msg):
     """Utility function to format and send a reply back to the ESP client."""
-    msg = {"to": TARGET_NAME, "msg": reply_msg}
-    await websocket.send(json.dumps(msg))
+    await websocket.send(encode_reply(reply_msg))
+    print(f"[REPLY] Sent to {TARGET_NAME}: {reply_msg}")
+
+async def send_raw(websocket, static_reply_pair):
+    """Sends a pre-encoded reply (one of the REPLY_* constants) back to the ESP client."""
+    reply_msg, payload_bytes = static_reply_pair
+    await websocket.send(payload_bytes)
     print(f"[REPLY] Sent to {TARGET_NAME}: {reply_msg}")
 
 async def handle_scan_command(websocket, id_value):
     """Handles the SCAN command (Attendance Logic)."""
     
     user_data = USER_DATABASE.get(id_value)
-    user_name = user_data['name'] if user_data else None
+    user_name = user_data.name if user_data else None
     
     # Check if the user is an admin
-    is_admin = user_data and user_data.get('title', '').lower() == 'admin'
+    is_admin = id_value in ADMIN_IDS
     
-    now = datetime.now()
+    now = datetime.now().replace(microsecond=0)
     current_time_str = now.strftime('%H:%M:%S')
-    ws = get_current_log_sheet()
     window_start, window_end, reset_time_str = get_current_reset_window()
 
     # --- Step 1: User Not Found ---
     if not user_name:
-        reply = {"md": "scan", "rslt": "NF"}
-        return await send_reply(websocket, reply)
+        return await send_raw(websocket, REPLY_SCAN_NF)
 
     # --- Find Last Log Entry within current 24h window ---
-    last_row_index, last_tap_in_time, last_status = find_last_entry(id_value, ws, window_start, window_end)
+    last_row_id, last_tap_in_time, last_status = find_last_entry(id_value, window_start, window_end)
 
     # --- Core Logic Flow (Prioritized) ---
     
@@ -261,69 +412,70 @@ async def handle_scan_command(websocket, id_value):
         duration_str = calculate_duration(last_tap_in_time, now)
         
         try:
-            wb = load_workbook(USER_LOG_FILE)
-            ws = wb.active
-            
-            # Note: last_row_index cannot be None here
-            ws.cell(row=last_row_index, column=3, value=now)
-            ws.cell(row=last_row_index, column=4, value='Tap Out')
-            ws.cell(row=last_row_index, column=5, value=duration_str)
-            wb.save(USER_LOG_FILE)
+            # Note: last_row_id cannot be None here
+            await asyncio.to_thread(update_user_log, last_row_id, now.strftime(LOG_TIME_FORMAT), duration_str)
+            LAST_ENTRY[id_value] = (last_row_id, last_tap_in_time, 'Tap Out')
             
             print(f"[SAVE] Log updated (Tap Out). Duration: {duration_str}")
 
             reply = {"md": "scan", "nm": user_name, "act": "OUT", "tm": current_time_str, "dur": duration_str}
             return await send_reply(websocket, reply)
         except Exception as e:
-            print(f"[ERROR] Failed to update user log file for Tap Out: {e}")
-            reply = {"md": "scan", "rslt": "LOG_ERR"}
-            return await send_reply(websocket, reply)
+            print(f"[ERROR] Failed to update user log for Tap Out: {e}")
+            return await send_raw(websocket, REPLY_SCAN_LOG_ERR)
 
     # 1. No Entry Found (Tap IN for all, including admins after Tap Out)
     elif last_status is None:
         
-        new_entry = [id_value, now, None, 'Tap In', None]
-        save_user_log(new_entry)
+        new_entry = [id_value, now.strftime(LOG_TIME_FORMAT), None, 'Tap In', None]
+        row_id = await asyncio.to_thread(save_user_log, new_entry)
+        if row_id is not None:
+            LAST_ENTRY[id_value] = (row_id, now, 'Tap In')
         
         reply = {"md": "scan", "nm": user_name, "act": "IN", "tm": current_time_str}
         return await send_reply(websocket, reply)
         
     else:
-        reply = {"md": "scan", "rslt": "UNKNOWN_ERR"}
-        return await send_reply(websocket, reply)
+        return await send_raw(websocket, REPLY_SCAN_UNKNOWN_ERR)
 
 async def handle_auth_command(websocket, id_value):
     """Handles the AUTH command (Admin check)."""
-    user_data = USER_DATABASE.get(id_value)
-    
-    if user_data and user_data.get('title', '').lower() == 'admin':
-        reply = {"md": "auth", "rslt": "admin"}
+    if id_value in ADMIN_IDS:
+        reply = REPLY_AUTH_ADMIN
     else:
-        reply = {"md": "auth", "rslt": "not-admin"}
+        reply = REPLY_AUTH_NOT_ADMIN
         
-    return await send_reply(websocket, reply)
+    return await send_raw(websocket, reply)
 
 async def handle_search_command(websocket, id_value):
     """Handles the SEARCH command (User existence check)."""
     
     if id_value in USER_DATABASE:
-        reply = {"md": "search", "rslt": "F"} # Found
+        reply = REPLY_SEARCH_F
     else:
-        reply = {"md": "search", "rslt": "NF"} # Not Found
+        reply = REPLY_SEARCH_NF
         
-    return await send_reply(websocket, reply)
+    return await send_raw(websocket, reply)
 
 async def handle_add_command(websocket, id_value, username, usertitle):
     """Handles the ADD command (Add new user)."""
     
+    # Reject non-string fields before touching the cache, like any other malformed command
+    if not all(isinstance(value, str) for value in (id_value, username, usertitle)):
+        print(f"\n[RECEIVED from {TARGET_NAME}]: Unknown/Malformed command: add {id_value!r} {username!r} {usertitle!r}")
+        return
+    
     # Update in-memory cache
-    USER_DATABASE[id_value] = {'name': username, 'title': usertitle}
+    USER_DATABASE[id_value] = User(username, usertitle)
+    if usertitle.lower() == 'admin':
+        ADMIN_IDS.add(id_value)
+    else:
+        ADMIN_IDS.discard(id_value)
     
-    # Save the updated database to the Excel file
-    save_user_db()
+    # Persist the single row to the database
+    await asyncio.to_thread(save_user_db, id_value, username, usertitle)
     
-    reply = {"md": "add", "rslt": "A"}
-    return await send_reply(websocket, reply)
+    return await send_raw(websocket, REPLY_ADD_A)
 
 async def handle_delete_command(websocket, id_value):
     """Handles the DELETE command (Delete existing user)."""
@@ -331,35 +483,42 @@ async def handle_delete_command(websocket, id_value):
     if id_value in USER_DATABASE:
         # Delete from in-memory cache
         del USER_DATABASE[id_value]
+        ADMIN_IDS.discard(id_value)
         
-        # Save the updated database to the Excel file
-        save_user_db()
-        
-        reply = {"md": "delete", "rslt": "DL"}
-    else:
-        # Reply DL even if not found, as the effect is the same (user is gone)
-        reply = {"md": "delete", "rslt": "DL"} 
+        # Remove the single row from the database
+        await asyncio.to_thread(delete_user_db, id_value)
 
-    return await send_reply(websocket, reply)
+    # Reply DL even if not found, as the effect is the same (user is gone)
+    return await send_raw(websocket, REPLY_DELETE_DL)
 
 async def handle_reset_time_command(websocket, time_value):
     """Handles the RST_TIME command (Update reset time)."""
     
-    # Basic validation (simple HH:MM:SS format check)
-    if not (2 <= time_value.count(':') <= 3):
+    # Strict validation: HH:MM:SS or HH:MM, parsed once here instead of on every scan
+    try:
+        reset_time = parse_reset_time(time_value)
+    except (TypeError, ValueError):
         print(f"[ERROR] Invalid time format received: {time_value}")
-        reply = {"md": "rst_time", "rslt": "FAIL"}
-        return await send_reply(websocket, reply)
+        return await send_raw(websocket, REPLY_RST_TIME_FAIL)
         
     # Update global settings and save
-    SETTINGS['reset_time'] = time_value
-    save_settings()
-    
-    # Reload the user database to ensure integrity (optional, but good practice)
-    load_user_db()
+    set_reset_time(reset_time)
+    await asyncio.to_thread(save_settings)
+
+    # The window moved, so entries it now covers may not be in LAST_ENTRY
+    await asyncio.to_thread(load_last_entries)
     
-    reply = {"md": "rst_time", "rslt": "D"}
-    return await send_reply(websocket, reply)
+    return await send_raw(websocket, REPLY_RST_TIME_D)
+
+# Command dispatch table: md -> (handler, required payload keys passed as positional args)
+HANDLERS = {
+    "scan": (handle_scan_command, ("id",)),
+    "auth": (handle_auth_command, ("id",)),
+    "search": (handle_search_command, ("id",)),
+    "add": (handle_add_command, ("id", "un", "ut")),
+    "delete": (handle_delete_command, ("id",)),
+    "rst_time": (handle_reset_time_command, ("tm",)),
+}
 
 # =============================================================
 # ASYNC CLIENT FUNCTIONS
@@ -370,7 +529,7 @@ async def receive_loop(websocket):
     try:
         async for message in websocket:
             try:
-                data = json.loads(message)
+                data = orjson.loads(message)
                 
                 # Check for forwarded messages from the ESP client
                 if data.get("from") == TARGET_NAME and "msg" in data:
@@ -379,24 +538,12 @@ async def receive_loop(websocket):
                     
                     print(f"\n[RECEIVED CMD] '{command_md}' from {TARGET_NAME}")
                     
-                    if command_md == "scan" and "id" in payload:
-                        await handle_scan_command(websocket, payload["id"])
-                        
-                    elif command_md == "auth" and "id" in payload:
-                        await handle_auth_command(websocket, payload["id"])
-
-                    elif command_md == "search" and "id" in payload:
-                        await handle_search_command(websocket, payload["id"])
-
-                    elif command_md == "add" and all(k in payload for k in ["id", "un", "ut"]):
-                        await handle_add_command(websocket, payload["id"], payload["un"], payload["ut"])
-
-                    elif command_md == "delete" and "id" in payload:
-                        await handle_delete_command(websocket, payload["id"])
-
-                    elif command_md == "rst_time" and "tm" in payload:
-                        await handle_reset_time_command(websocket, payload["tm"])
-
+                    # md may be any JSON value; only strings can name a handler
+                    handler, required_keys = None, ()
+                    if isinstance(command_md, str):
+                        handler, required_keys = HANDLERS.get(command_md, (None, ()))
+                    if handler and all(k in payload for k in required_keys):
+                        await handler(websocket, *[payload[k] for k in required_keys])
                     else:
                         print(f"\n[RECEIVED from {TARGET_NAME}]: Unknown/Malformed command: {payload}")
                 
@@ -407,7 +554,7 @@ async def receive_loop(websocket):
                 else:
                     print(f"\n[RAW MESSAGE] (Not from {TARGET_NAME}): {message}")
 
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 print(f"\n[ERROR] Received invalid JSON: {message}")
             except Exception as e:
                 print(f"\n[ERROR] An error occurred in receiver: {e}")
@@ -425,13 +572,14 @@ async def connect_and_run():
     initialize_files()
     load_settings()
     load_user_db()
+    load_last_entries()
     
     try:
         # Note: Using localhost requires the server to be running on the same machine
-        async with websockets.connect(SERVER_URL) as websocket:
+        async with websockets.connect(SERVER_URL, compression=None) as websocket:
             
             # Send registration message immediately
-            registration_msg = json.dumps({"type": "register", "name": CLIENT_NAME})
+            registration_msg = orjson.dumps({"type": "register", "name": CLIENT_NAME})
             await websocket.send(registration_msg)
             
             # Run the receiver loop
@@ -449,7 +597,8 @@ if __name__ == "__main__":
     import os
     try:
         # The client now runs a single async function that loops forever
-        asyncio.run(connect_and_run())
+        run = getattr(uvloop, "run", asyncio.run)
+        run(connect_and_run())
     except KeyboardInterrupt:
         print("\n[INFO] Client application interrupted.")
     except Exception as e:
@@ -3,6 +3,11 @@ import websockets
 import json
 # Removed: import logging
 
+try:
+    import uvloop # Optional: faster libuv-based event loop (not available on Windows)
+except ImportError:
+    uvloop = None
+
 # Dictionary to store connected clients, mapping client name to its WebSocket object
 CLIENTS = {}
 SERVER_PORT = 8765
@@ -21,6 +26,8 @@ async def router(websocket, path=None):
         # Check for registration payload structure used by client files: {"type": "register", "name": "..."}
         if data.get("type") == "register" and "name" in data:
             client_name = data["name"]
+            # Forwarded frames are built by splicing this prefix onto the sender's original envelope
+            forward_prefix = '{"from":' + json.dumps(client_name) + ','
             
             # --- Inline Registration Logic ---
             CLIENTS[client_name] = websocket
@@ -36,6 +43,9 @@ async def router(websocket, path=None):
         # 2. Main Message Loop
         async for message in websocket:
             try:
+                # Forward everything as text, since the ESP ignores binary frames
+                if isinstance(message, bytes):
+                    message = message.decode("utf-8")
                 data = json.loads(message)
                 
                 # Expected format from clients: { "to": "recipient_name", "msg": { ... } }
@@ -46,13 +56,15 @@ async def router(websocket, path=None):
                     recipient_ws = CLIENTS.get(recipient_name)
                     
                     if recipient_ws:
-                        # Add sender info to the payload before forwarding
-                        payload_with_sender = {
-                            "from": client_name,
-                            "msg": payload
-                        }
+                        # Add sender info without re-encoding the payload: the envelope
+                        # {"to": ..., "msg": ...} becomes {"from": ..., "to": ..., "msg": ...}
+                        if "from" in data:
+                            # Never let a sender-supplied "from" shadow the real one
+                            forwarded = json.dumps({"from": client_name, "msg": payload})
+                        else:
+                            forwarded = forward_prefix + message.strip()[1:]
                         
-                        await recipient_ws.send(json.dumps(payload_with_sender))
+                        await recipient_ws.send(forwarded)
                         print(f"[SERVER] {client_name} → {recipient_name}. Payload: {payload}")
                     else:
                         error_msg = {"error": f"Recipient '{recipient_name}' not found."}
@@ -88,11 +100,14 @@ async def main():
     """Sets up and runs the WebSocket server."""
     bind_host = "0.0.0.0"
     print(f"[SERVER] WebSocket server running on ws://{bind_host}:{SERVER_PORT}")
-    async with websockets.serve(router, bind_host, SERVER_PORT):
+    # permessage-deflate off: tiny JSON payloads gain nothing from compression
+    async with websockets.serve(router, bind_host, SERVER_PORT, compression=None):
         await asyncio.Future()  # Run forever
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        # uvloop.run() needs uvloop >= 0.18; older versions (or no uvloop) use asyncio.run()
+        run = getattr(uvloop, "run", asyncio.run)
+        run(main())
     except KeyboardInterrupt:
         print("[SERVER] Server stopped manually.")